@@ -0,0 +1,135 @@
+import asyncio
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from typing import AsyncIterator, Iterator, Optional, Tuple
+import httpx
+from groq import AsyncGroq, AsyncStream, DefaultAsyncHttpxClient, DefaultHttpxClient, Groq, Stream
+
+# Keep every pooled connection alive between bursts so fan-out reuses
+# sockets instead of re-handshaking (SDK default keeps only 20 idle).
+_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=100, keepalive_expiry=60)
+_TIMEOUT = httpx.Timeout(60.0, connect=10.0)
+
+# The SDK retries 408/409/429/5xx and connection errors with jittered
+# exponential backoff and honours Retry-After; allow one more than its default.
+_MAX_RETRIES = 3
+
+# HTTP/2 lets concurrent requests share one TLS connection; httpx needs h2 for it
+try:
+    import h2  # noqa: F401
+    _HTTP2 = True
+except ImportError:
+    _HTTP2 = False
+
+# One client per API key, most recently used last. Bounded so arbitrary
+# user-supplied keys can't pile up pools; an evicted client is only dropped,
+# not closed, since other threads may still be mid-request on it. Its pool is
+# released once the last reference goes away.
+_MAX_CLIENTS = 8
+_clients: "OrderedDict[str, Groq]" = OrderedDict()
+# An AsyncGroq pool only works on the event loop that opened it, and
+# asyncio.run() or a Streamlit rerun starts a new loop each time, so async
+# clients are kept per (API key, loop). Clients of finished loops are dropped.
+_async_clients: "OrderedDict[Tuple[str, int], Tuple[weakref.ref, AsyncGroq]]" = OrderedDict()
+_lock = threading.Lock()
+
+def get_client(groq_api_key: str) -> Groq:
+    # One client per API key so back-to-back calls reuse kept-alive connections
+    with _lock:
+        client = _clients.get(groq_api_key)
+        if client is None:
+            client = _clients[groq_api_key] = Groq(
+                api_key=groq_api_key,
+                max_retries=_MAX_RETRIES,
+                http_client=DefaultHttpxClient(limits=_LIMITS, timeout=_TIMEOUT, http2=_HTTP2),
+            )
+            if len(_clients) > _MAX_CLIENTS:
+                _clients.popitem(last=False)
+        else:
+            _clients.move_to_end(groq_api_key)
+        return client
+
+def get_async_client(groq_api_key: str) -> AsyncGroq:
+    # One client per API key and event loop so concurrent calls share a single
+    # connection pool; must be called from a coroutine
+    loop = asyncio.get_running_loop()
+    slot = (groq_api_key, id(loop))
+    with _lock:
+        entry = _async_clients.get(slot)
+        if entry is not None and entry[0]() is loop:
+            _async_clients.move_to_end(slot)
+            return entry[1]
+        for stale in [k for k, (ref, _) in _async_clients.items() if ref() is None or ref().is_closed()]:
+            del _async_clients[stale]
+        client = AsyncGroq(
+            api_key=groq_api_key,
+            max_retries=_MAX_RETRIES,
+            http_client=DefaultAsyncHttpxClient(limits=_LIMITS, timeout=_TIMEOUT, http2=_HTTP2),
+        )
+        _async_clients[slot] = (weakref.ref(loop), client)
+        if len(_async_clients) > _MAX_CLIENTS:
+            _async_clients.popitem(last=False)
+        return client
+
+def close_all_clients() -> None:
+    # For shutdown: release pooled sockets; the next get_client() starts fresh
+    with _lock:
+        clients = list(_clients.values())
+        _clients.clear()
+    for client in clients:
+        client.close()
+
+async def aclose_all_clients() -> None:
+    # Async counterpart; closes the clients opened on the running loop
+    loop = asyncio.get_running_loop()
+    with _lock:
+        mine = [k for k, (ref, _) in _async_clients.items() if ref() is loop]
+        clients = [_async_clients.pop(k)[1] for k in mine]
+    await asyncio.gather(*(client.close() for client in clients), return_exceptions=True)
+
+def iter_deltas(stream: Stream) -> Iterator[str]:
+    # Non-empty text deltas of a streamed chat completion. The stream is closed
+    # when iteration ends or the generator is closed, so wrap it in
+    # contextlib.closing() when the caller may stop early.
+    try:
+        for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                yield delta
+    finally:
+        stream.close()
+
+async def aiter_deltas(stream: AsyncStream) -> AsyncIterator[str]:
+    # Async counterpart of iter_deltas; callers that may stop early should
+    # aclose() the generator so the stream is closed on their loop
+    try:
+        async for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                yield delta
+    finally:
+        await stream.close()
+
+def warm_up(groq_api_key: str) -> Optional[float]:
+    # Best-effort: open a pooled connection (TCP + TLS) before the first real
+    # request, e.g. from a startup thread. Returns seconds taken, None on failure.
+    start = time.perf_counter()
+    try:
+        get_client(groq_api_key).models.list()
+    except Exception:
+        return None
+    return time.perf_counter() - start
+
+async def awarm_up(groq_api_key: str, connections: int = 4) -> Optional[float]:
+    # Concurrent probes make the async pool open several sockets up front
+    start = time.perf_counter()
+    client = get_async_client(groq_api_key)
+    results = await asyncio.gather(
+        *(client.models.list() for _ in range(connections)),
+        return_exceptions=True,
+    )
+    if all(isinstance(r, Exception) for r in results):
+        return None
+    return time.perf_counter() - start
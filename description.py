@@ -1,9 +1,39 @@
+import asyncio
+import copy
 import json
-from typing import Dict, Any, List
-from groq import Groq
+import logging
+import re
+from concurrent.futures import Future
+from contextlib import closing
+from functools import lru_cache
+from typing import Dict, Any, Iterable, Iterator, List, Optional
+from clients import get_async_client, get_client, iter_deltas
+from response_cache import ResponseCache, cache_dir, hash_token, make_key, normalize_prompt
+from word_budgets import NARRATIVE_WORDS, TAGLINE_WORDS, enforce_word_budgets
 
+try:
+    import orjson  # optional: faster parsing of model output
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
+logger = logging.getLogger(__name__)
+
+_cache = ResponseCache(max_entries=256, ttl=3600, directory=cache_dir("scenes"))
+
+# Identical scene requests already on the wire; later callers wait for the same
+# result. Sync and async callers never share an entry: a sync caller blocking on
+# an async leader running on its own thread's event loop would deadlock it.
+_inflight: Dict[str, Future] = {}
+_ainflight: Dict[str, Future] = {}
+
+class _LeaderAborted(Exception):
+    """The coalesced request was interrupted before producing a result."""
+
+@lru_cache(maxsize=1)
 def build_default_schema() -> Dict[str, Any]:
-    # Example JSON schema for scenes; adjust to your exact structure
+    # Example JSON schema for scenes; adjust to your exact structure.
+    # Cached: every call returns the same dict, so treat it as read-only.
     return {
         "type": "object",
         "properties": {
@@ -28,24 +58,138 @@ def build_default_schema() -> Dict[str, Any]:
         "required": ["scenes"],
     }
 
+@lru_cache(maxsize=1)
+def build_unified_schema() -> Dict[str, Any]:
+    # Scene schema plus the storyline fields, for single-call generation.
+    schema = copy.deepcopy(build_default_schema())
+    schema["properties"] = {
+        "tagline": {"type": "string"},
+        "narrative": {"type": "string"},
+        **schema["properties"],
+    }
+    schema["required"] = ["tagline", "narrative", "scenes"]
+    return schema
+
+@lru_cache(maxsize=1)
+def build_bulk_schema() -> Dict[str, Any]:
+    # One storyboard per input storyline, for several storylines in one call.
+    scenes = copy.deepcopy(build_default_schema()["properties"]["scenes"])
+    return {
+        "type": "object",
+        "properties": {
+            "storyboards": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "storyline_id": {"type": "string"},
+                        "scenes": scenes,
+                    },
+                    "required": ["storyline_id", "scenes"],
+                },
+            }
+        },
+        "required": ["storyboards"],
+    }
+
+_BUILTIN_SCHEMAS = (build_default_schema, build_unified_schema, build_bulk_schema)
+
+@lru_cache(maxsize=None)
+def _builtin_schema_str(builder) -> str:
+    return json.dumps(builder(), separators=(",", ":"))
+
+def _dump_schema(json_schema: Dict[str, Any]) -> str:
+    # Compact separators: indentation is only extra input tokens for the model.
+    # The built-in schemas are static, so serialize them once per process.
+    for builder in _BUILTIN_SCHEMAS:
+        if json_schema is builder():
+            return _builtin_schema_str(builder)
+    return json.dumps(json_schema, separators=(",", ":"))
+
+def cache_stats() -> Dict[str, Any]:
+    return _cache.stats()
+
+_SYSTEM_MSG = "Return only a valid JSON object that conforms to the schema. No extra text."
+
+def _system_prompt(json_schema: Dict[str, Any]) -> str:
+    # Static instructions + schema first: an identical prefix on every request
+    # lets providers with automatic prompt caching skip re-prefilling it
+    return f"{_SYSTEM_MSG}\n\nJSON Schema:\n{_dump_schema(json_schema)}"
+
+_decoder = json.JSONDecoder()
+
+# Body of a ```json ... ``` (or bare ```) fence anywhere in the reply
+_FENCE_RE = re.compile(r"```(?:json)?\s*(.*?)\s*```", re.DOTALL | re.IGNORECASE)
+
+def _iter_scenes(chunks: Iterable[str]) -> Iterator[Dict[str, Any]]:
+    # Yield each object of the "scenes" array as soon as its closing brace arrives
+    buf = ""
+    pos = -1  # just past the "[" of the scenes array once seen
+    done = False
+    for chunk in chunks:
+        buf += chunk
+        if done:
+            continue
+        if pos < 0:
+            key = buf.find('"scenes"')
+            bracket = buf.find("[", key) if key != -1 else -1
+            if bracket == -1:
+                continue
+            pos = bracket + 1
+        elif "}" not in chunk:
+            continue  # nothing can have closed since the last attempt
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n,":
+                pos += 1
+            if pos >= len(buf):
+                break
+            if buf[pos] == "]":
+                done = True
+                break
+            try:
+                obj, pos = _decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                break  # current scene is still incomplete
+            if isinstance(obj, dict):
+                yield obj
+
 class SceneGenerator:
-    def __init__(self, groq_api_key: str, model: str = "llama-3.3-70b-versatile", temperature: float = 0.7):
-        self.client = Groq(api_key=groq_api_key)
+    def __init__(self, groq_api_key: str, model: str = "llama-3.3-70b-versatile", temperature: float = 0.7, use_cache: bool = True):
+        self.groq_api_key = groq_api_key
         self.model = model
         self.temperature = temperature
+        self.use_cache = use_cache
 
-    def _build_scene_prompt(
+    def _cache_key(
         self,
         storyline: Dict[str, str],
         num_scenes: int,
         video_length: str,
         json_schema: Dict[str, Any],
     ) -> str:
-        schema_str = json.dumps(json_schema, indent=2)
+        # Only the fields that reach the prompt take part in the key
+        return make_key(
+            "scenes",
+            storyline.get("tagline", ""),
+            storyline.get("narrative", ""),
+            num_scenes,
+            video_length,
+            _dump_schema(json_schema),
+            self.model,
+            self.temperature,
+            hash_token(self.groq_api_key),
+        )
+
+    def _build_scene_prompt(
+        self,
+        storyline: Dict[str, str],
+        num_scenes: int,
+        video_length: str,
+    ) -> str:
         return f"""You are a marketing director and storyboard artist.
 
 Create a scene breakdown for a {video_length} vertical ad based on the following storyline.
-Return a STRICT JSON object that validates against the provided JSON Schema. Do not include any text outside JSON.
+Return a STRICT JSON object that validates against the JSON Schema in the system message. Do not include any text outside JSON.
 
 Storyline:
 Tagline: {storyline.get("tagline","")}
@@ -56,41 +200,366 @@ Requirements:
 - Each scene should include: id, title, shot_type, visuals, voiceover, on_screen_text, duration_sec, cta (if applicable).
 - Total time budget should roughly match the {video_length}.
 - Keep language concise and production-ready.
-
-JSON Schema:
-{schema_str}
 """
 
-    def generate_scenes(
+    def _build_messages(
         self,
         storyline: Dict[str, str],
         num_scenes: int,
         video_length: str,
         json_schema: Dict[str, Any],
-    ) -> List[Dict[str, Any]]:
-        prompt = self._build_scene_prompt(storyline, num_scenes, video_length, json_schema)
+    ) -> List[Dict[str, str]]:
+        prompt = self._build_scene_prompt(storyline, num_scenes, video_length)
 
         # Use JSON-style prompting. If desired, you can add a JSON mode hint in the system message.
-        messages = [
-            {"role": "system", "content": "Return only a valid JSON object that conforms to the schema. No extra text."},
+        return [
+            {"role": "system", "content": _system_prompt(json_schema)},
             {"role": "user", "content": prompt},
         ]
+
+    def _build_unified_prompt(
+        self,
+        product_input: str,
+        num_scenes: int,
+        video_length: str,
+    ) -> str:
+        return f"""You are a creative marketing expert, marketing director and storyboard artist.
+
+Based on the following product details, write a tagline and a marketing narrative, then break them down into scenes for a {video_length} vertical ad.
+Return a STRICT JSON object that validates against the JSON Schema in the system message. Do not include any text outside JSON.
+
+Product Details: {product_input}
+
+Requirements:
+- tagline: a short tagline ({TAGLINE_WORDS[0]}–{TAGLINE_WORDS[1]} words maximum).
+- narrative: a full marketing narrative ({NARRATIVE_WORDS[0]}–{NARRATIVE_WORDS[1]} words).
+- Exactly {num_scenes} scenes.
+- Each scene should include: id, title, shot_type, visuals, voiceover, on_screen_text, duration_sec, cta (if applicable).
+- Total time budget should roughly match the {video_length}.
+- Keep language concise and production-ready.
+"""
+
+    def _build_bulk_prompt(
+        self,
+        storylines: Dict[str, Dict[str, str]],
+        num_scenes: int,
+        video_length: str,
+    ) -> str:
+        listed = "\n\n".join(
+            f"""[storyline_id: {sid}]
+Tagline: {s.get("tagline","")}
+Narrative: {s.get("narrative","")}"""
+            for sid, s in storylines.items()
+        )
+        return f"""You are a marketing director and storyboard artist.
+
+Create a scene breakdown for a {video_length} vertical ad for EACH of the following storylines.
+Return a STRICT JSON object that validates against the JSON Schema in the system message. Do not include any text outside JSON.
+
+Storylines:
+{listed}
+
+Requirements:
+- One storyboard per storyline, with storyline_id copied exactly from the list above.
+- Exactly {num_scenes} scenes per storyboard.
+- Each scene should include: id, title, shot_type, visuals, voiceover, on_screen_text, duration_sec, cta (if applicable).
+- Total time budget of each storyboard should roughly match the {video_length}.
+- Keep language concise and production-ready.
+"""
+
+    @staticmethod
+    def _extract_json(text: str) -> Dict[str, Any]:
+        # Best-effort JSON extraction/parsing
+        m = _FENCE_RE.search(text)
+        if m:
+            text = m.group(1)
         try:
-            resp = self.client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                temperature=self.temperature,
-            )
+            # Common case: the (unfenced) reply is exactly one JSON object
+            return _loads(text)
+        except ValueError:
+            pass
+        start = text.find("{")
+        if start < 0:
+            return _loads(text)
+        # Decode straight from the first brace in one native pass; trailing chatter is ignored
+        return _decoder.raw_decode(text, start)[0]
+
+    @classmethod
+    def _parse_scenes(cls, text: str) -> List[Dict[str, Any]]:
+        data = cls._extract_json(text)
+        scenes = data.get("scenes", [])
+        return scenes
+
+    def _request_scenes(self, messages: List[Dict[str, str]]) -> List[Dict[str, Any]]:
+        try:
+            with _cache.timed():
+                resp = get_client(self.groq_api_key).chat.completions.create(
+                    model=self.model,
+                    messages=messages,
+                    temperature=self.temperature,
+                )
             text = resp.choices[0].message.content or ""
-            # Best-effort JSON extraction/parsing
-            start = text.find("{")
-            end = text.rfind("}")
-            if start != -1 and end != -1 and end > start:
-                text = text[start:end+1]
-            data = json.loads(text)
-            scenes = data.get("scenes", [])
-            return scenes
+            return self._parse_scenes(text)
         except Exception as e:
-            # Optionally log e
+            logger.warning("Scene generation failed (%s): %s", self.model, e)
             return []
 
+    async def _arequest_scenes(self, messages: List[Dict[str, str]]) -> List[Dict[str, Any]]:
+        try:
+            with _cache.timed():
+                resp = await get_async_client(self.groq_api_key).chat.completions.create(
+                    model=self.model,
+                    messages=messages,
+                    temperature=self.temperature,
+                )
+            text = resp.choices[0].message.content or ""
+            return self._parse_scenes(text)
+        except Exception as e:
+            logger.warning("Scene generation failed (%s): %s", self.model, e)
+            return []
+
+    def generate_scenes(
+        self,
+        storyline: Dict[str, str],
+        num_scenes: int,
+        video_length: str,
+        json_schema: Optional[Dict[str, Any]] = None,
+    ) -> List[Dict[str, Any]]:
+        json_schema = json_schema or build_default_schema()
+        key = self._cache_key(storyline, num_scenes, video_length, json_schema)
+        if self.use_cache:
+            cached = _cache.get(key)
+            if cached is not None:
+                return cached
+
+        while True:
+            fut: Future = Future()
+            leader = _inflight.setdefault(key, fut)
+            if leader is fut:
+                break
+            try:
+                return copy.deepcopy(leader.result())
+            except _LeaderAborted:
+                continue  # retry, possibly as the new leader
+        fut.set_running_or_notify_cancel()  # followers can no longer cancel it
+
+        scenes: Optional[List[Dict[str, Any]]] = None
+        try:
+            messages = self._build_messages(storyline, num_scenes, video_length, json_schema)
+            scenes = self._request_scenes(messages)
+            if scenes:
+                _cache.set(key, scenes)
+            return scenes
+        finally:
+            _inflight.pop(key, None)
+            if scenes is None:
+                fut.set_exception(_LeaderAborted())
+            else:
+                fut.set_result(copy.deepcopy(scenes))
+
+    async def agenerate_scenes(
+        self,
+        storyline: Dict[str, str],
+        num_scenes: int,
+        video_length: str,
+        json_schema: Optional[Dict[str, Any]] = None,
+    ) -> List[Dict[str, Any]]:
+        json_schema = json_schema or build_default_schema()
+        key = self._cache_key(storyline, num_scenes, video_length, json_schema)
+        if self.use_cache:
+            cached = _cache.get(key)
+            if cached is not None:
+                return cached
+
+        # concurrent.futures.Future so callers on other threads/event loops can join too
+        while True:
+            fut: Future = Future()
+            leader = _ainflight.setdefault(key, fut)
+            if leader is fut:
+                break
+            try:
+                # Shielded: a follower that times out or is cancelled must not cancel the shared result
+                return copy.deepcopy(await asyncio.shield(asyncio.wrap_future(leader)))
+            except _LeaderAborted:
+                continue
+        fut.set_running_or_notify_cancel()
+
+        scenes: Optional[List[Dict[str, Any]]] = None
+        try:
+            messages = self._build_messages(storyline, num_scenes, video_length, json_schema)
+            scenes = await self._arequest_scenes(messages)
+            if scenes:
+                _cache.set(key, scenes)
+            return scenes
+        finally:
+            _ainflight.pop(key, None)
+            if scenes is None:
+                fut.set_exception(_LeaderAborted())
+            else:
+                fut.set_result(copy.deepcopy(scenes))
+
+    async def agenerate_scenes_batch(
+        self,
+        storylines: List[Dict[str, str]],
+        num_scenes: int,
+        video_length: str,
+        json_schema: Optional[Dict[str, Any]] = None,
+        max_concurrency: int = 8,
+    ) -> List[List[Dict[str, Any]]]:
+        # Scenes for several storylines at once, bounded to stay under rate limits
+        sem = asyncio.Semaphore(max_concurrency)
+
+        async def _one(storyline: Dict[str, str]) -> List[Dict[str, Any]]:
+            async with sem:
+                return await self.agenerate_scenes(storyline, num_scenes, video_length, json_schema)
+
+        return await asyncio.gather(*(_one(s) for s in storylines))
+
+    def generate_scenes_bulk(
+        self,
+        storylines: List[Dict[str, str]],
+        num_scenes: int,
+        video_length: str,
+    ) -> Dict[str, List[Dict[str, Any]]]:
+        # Scenes for several storylines from one round-trip; the shared preamble
+        # and schema are sent once instead of per storyline. Storylines are keyed
+        # by their "id" field, or by position when it is missing.
+        by_id = {str(s.get("id", i)): s for i, s in enumerate(storylines)}
+        if len(by_id) != len(storylines):
+            raise ValueError("storyline ids must be unique")
+        if not by_id:
+            return {}
+
+        json_schema = build_bulk_schema()
+        key = make_key(
+            "bulk",
+            [(sid, s.get("tagline", ""), s.get("narrative", "")) for sid, s in by_id.items()],
+            num_scenes,
+            video_length,
+            self.model,
+            self.temperature,
+            hash_token(self.groq_api_key),
+        )
+        if self.use_cache:
+            cached = _cache.get(key)
+            if cached is not None:
+                return cached
+
+        messages = [
+            {"role": "system", "content": _system_prompt(json_schema)},
+            {"role": "user", "content": self._build_bulk_prompt(by_id, num_scenes, video_length)},
+        ]
+        result: Dict[str, List[Dict[str, Any]]] = {sid: [] for sid in by_id}
+        try:
+            with _cache.timed():
+                resp = get_client(self.groq_api_key).chat.completions.create(
+                    model=self.model,
+                    messages=messages,
+                    temperature=self.temperature,
+                )
+            data = self._extract_json(resp.choices[0].message.content or "")
+            boards = data.get("storyboards", []) if isinstance(data, dict) else []
+            for board in boards if isinstance(boards, list) else []:
+                if not isinstance(board, dict):
+                    continue
+                sid = str(board.get("storyline_id", ""))
+                scenes = board.get("scenes", [])
+                if sid in result and isinstance(scenes, list):
+                    result[sid] = scenes
+        except Exception as e:
+            logger.warning("Bulk scene generation failed (%s): %s", self.model, e)
+            return {sid: [] for sid in by_id}
+
+        if all(result.values()):
+            _cache.set(key, result)
+        return result
+
+    def generate_scenes_stream(
+        self,
+        storyline: Dict[str, str],
+        num_scenes: int,
+        video_length: str,
+        json_schema: Optional[Dict[str, Any]] = None,
+    ) -> Iterator[Dict[str, Any]]:
+        # Yields scenes one by one while the model is still writing the rest
+        json_schema = json_schema or build_default_schema()
+        key = self._cache_key(storyline, num_scenes, video_length, json_schema)
+        if self.use_cache:
+            cached = _cache.get(key)
+            if cached is not None:
+                yield from cached
+                return
+
+        messages = self._build_messages(storyline, num_scenes, video_length, json_schema)
+        scenes = []
+        try:
+            with _cache.timed():
+                stream = get_client(self.groq_api_key).chat.completions.create(
+                    model=self.model,
+                    messages=messages,
+                    temperature=self.temperature,
+                    stream=True,
+                )
+                with closing(iter_deltas(stream)) as deltas:
+                    for scene in _iter_scenes(deltas):
+                        scenes.append(scene)
+                        yield copy.deepcopy(scene)
+        except Exception as e:
+            logger.warning("Scene streaming failed (%s): %s", self.model, e)
+            return
+        if scenes:
+            _cache.set(key, scenes)
+
+    def generate_unified(
+        self,
+        product_input: str,
+        num_scenes: int,
+        video_length: str,
+        json_schema: Optional[Dict[str, Any]] = None,
+    ) -> Dict[str, Any]:
+        # Tagline, narrative and scenes in one round-trip instead of two chained calls
+        json_schema = json_schema or build_unified_schema()
+        key = make_key(
+            "unified",
+            normalize_prompt(product_input),
+            num_scenes,
+            video_length,
+            _dump_schema(json_schema),
+            self.model,
+            self.temperature,
+            hash_token(self.groq_api_key),
+        )
+        if self.use_cache:
+            cached = _cache.get(key)
+            if cached is not None:
+                return cached
+
+        messages = [
+            {"role": "system", "content": _system_prompt(json_schema)},
+            {"role": "user", "content": self._build_unified_prompt(product_input, num_scenes, video_length)},
+        ]
+        try:
+            with _cache.timed():
+                resp = get_client(self.groq_api_key).chat.completions.create(
+                    model=self.model,
+                    messages=messages,
+                    temperature=self.temperature,
+                )
+            data = self._extract_json(resp.choices[0].message.content or "")
+            tagline, narrative, too_short = enforce_word_budgets(
+                str(data.get("tagline", "")), str(data.get("narrative", ""))
+            )
+            result = {
+                "success": True,
+                "tagline": tagline,
+                "narrative": narrative,
+                "scenes": data.get("scenes", []),
+                "model": self.model,
+                "too_short": too_short,
+            }
+            if result["scenes"] and not too_short:
+                _cache.set(key, result)
+            return result
+        except Exception as e:
+            logger.warning("Unified generation failed (%s): %s", self.model, e)
+            return {"success": False, "error": f"Groq chat error: {e}"}
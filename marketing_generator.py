@@ -1,66 +1,346 @@
-from typing import Dict, Any
-from groq import Groq
+import asyncio
+import json
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import closing
+from typing import Dict, Any, AsyncIterator, Iterator, List, Tuple
+from clients import aiter_deltas, get_async_client, get_client, iter_deltas
+from response_cache import ResponseCache, cache_dir, hash_token, make_key, normalize_prompt
+from word_budgets import NARRATIVE_WORDS, TAGLINE_WORDS, enforce_word_budgets
 
-def _build_prompt(product_input: str) -> str:
-    return f"""You are a creative marketing expert. Based on the following product details, create:
+_cache = ResponseCache(max_entries=256, ttl=3600, directory=cache_dir("storyline"))
+
+logger = logging.getLogger(__name__)
+
+# Output token cap per request: enough for the word budgets (~1.3 tokens/word
+# plus labels), growing with longer product details up to the upper bound. The
+# cap is what stops generation past the budget; closing a stream early instead
+# would make httpx discard the pooled connection and re-handshake next call.
+_MAX_TOKENS = (240, 400)
+# One pass over the reply; the narrative may span several lines/paragraphs
+_SECTIONS_RE = re.compile(
+    r"TAGLINE:[ \t]*(?P<tag>[^\n]*)(?:.*?NARRATIVE:\s*(?P<nar>.+))?",
+    re.DOTALL | re.IGNORECASE,
+)
+# Sign-off chatter or a closing fence after the narrative; cut from its line onwards
+_TRAILER_RE = re.compile(
+    r"\n[ \t]*(?:```|---|let me know|i hope|hope this|feel free|would you like|note:).*\Z",
+    re.DOTALL | re.IGNORECASE,
+)
+# Character caps when the model ignores the TAGLINE:/NARRATIVE: labels
+_FALLBACK_TAGLINE_CHARS = 120
+_FALLBACK_NARRATIVE_CHARS = 1500
+
+# Circuit breaker: after this many consecutive failures for a model/key, fail
+# fast for the cooldown instead of waiting out timeouts and SDK retries again
+_BREAKER_FAILURES = int(os.getenv("MARKETING_BREAKER_FAILURES", "3"))
+_BREAKER_COOLDOWN = float(os.getenv("MARKETING_BREAKER_COOLDOWN", "60"))
+_breaker: Dict[str, Tuple[int, float]] = {}  # name -> (consecutive failures, open until)
+_breaker_lock = threading.Lock()
+
+def _breaker_name(groq_api_key: str, model: str) -> str:
+    return f"{model}:{hash_token(groq_api_key)}"
+
+def _breaker_open(name: str) -> bool:
+    with _breaker_lock:
+        _, open_until = _breaker.get(name, (0, 0.0))
+    return open_until > time.monotonic()
+
+def _breaker_record(name: str, ok: bool) -> None:
+    with _breaker_lock:
+        if ok:
+            _breaker.pop(name, None)
+            return
+        failures = _breaker.get(name, (0, 0.0))[0] + 1
+        open_until = time.monotonic() + _BREAKER_COOLDOWN if failures >= _BREAKER_FAILURES else 0.0
+        _breaker[name] = (failures, open_until)
+    if open_until:
+        logger.warning("Model %s failed %d times in a row; skipping it for %.0fs", name.split(":")[0], failures, _BREAKER_COOLDOWN)
 
-1. A short tagline (10–15 words maximum)
-2. A full marketing narrative (100–150 words)
+def cache_stats() -> Dict[str, Any]:
+    return _cache.stats()
 
-Product Details: {product_input}
+# Everything but the product details, sent first as the system message
+_STATIC_INSTRUCTIONS = f"""You are a creative marketing expert. Based on the product details you are given, create:
+
+1. A short tagline ({TAGLINE_WORDS[0]}–{TAGLINE_WORDS[1]} words maximum)
+2. A full marketing narrative ({NARRATIVE_WORDS[0]}–{NARRATIVE_WORDS[1]} words)
 
 Format your response exactly as:
 TAGLINE: <tagline>
 NARRATIVE: <narrative>
-"""
 
-def generate_storyline(product_input: str, groq_api_key: str, model: str = "llama-3.3-70b-versatile") -> Dict[str, Any]:
-    client = Groq(api_key=groq_api_key)  # GROQ_API_KEY from env or secrets
+Return only the requested sections."""
+
+def _build_prompt(product_input: str) -> str:
+    return f"Product Details: {product_input}"
 
-    messages = [
-        {"role": "system", "content": "Return only the requested sections."},
+def _build_messages(product_input: str) -> List[Dict[str, str]]:
+    return [
+        {"role": "system", "content": _STATIC_INSTRUCTIONS},
         {"role": "user", "content": _build_prompt(product_input)},
     ]
 
+def parse_storyline(text: str, model: str) -> Dict[str, Any]:
+    tagline, narrative = "", ""
+    m = _SECTIONS_RE.search(text)
+    if m:
+        tagline = m.group("tag").strip()
+        narrative = _TRAILER_RE.sub("", m.group("nar") or "").strip()
+
+    # Fallback parsing
+    if not tagline or not narrative:
+        lines = [ln.strip() for ln in text.splitlines() if ln.strip()]
+        if lines:
+            tagline = tagline or lines[0][:_FALLBACK_TAGLINE_CHARS]
+            narrative = narrative or " ".join(lines[1:])[:_FALLBACK_NARRATIVE_CHARS]
+
+    tagline, narrative, too_short = enforce_word_budgets(tagline, narrative)
+    return {"success": True, "tagline": tagline, "narrative": narrative, "model": model, "too_short": too_short}
+
+def _max_tokens(product_input: str) -> int:
+    # ~4 characters per input token; a third of that again as output headroom
+    return min(_MAX_TOKENS[1], _MAX_TOKENS[0] + len(product_input) // 12)
+
+def _cache_key(product_input: str, groq_api_key: str, model: str) -> str:
+    return make_key("storyline", normalize_prompt(product_input), model, 0.7, hash_token(groq_api_key))
+
+def generate_storyline(product_input: str, groq_api_key: str, model: str = "llama-3.3-70b-versatile", use_cache: bool = True) -> Dict[str, Any]:
+    key = _cache_key(product_input, groq_api_key, model)
+    if use_cache:
+        cached = _cache.get(key)
+        if cached is not None:
+            return cached
+
+    breaker = _breaker_name(groq_api_key, model)
+    if _breaker_open(breaker):
+        return {"success": False, "error": f"Groq chat error: {model} is temporarily skipped after repeated failures"}
+
+    client = get_client(groq_api_key)  # GROQ_API_KEY from env or secrets
+
     try:
-        resp = client.chat.completions.create(
-            model=model,
-            messages=messages,
-            temperature=0.7,
-        )  # OpenAI-compatible chat completions on Groq
+        with _cache.timed():
+            resp = client.chat.completions.create(
+                model=model,
+                messages=_build_messages(product_input),
+                temperature=0.7,
+                max_tokens=_max_tokens(product_input),
+            )  # OpenAI-compatible chat completions on Groq
         text = resp.choices[0].message.content or ""
+        result = parse_storyline(text, model)
+        _breaker_record(breaker, ok=True)
+        if not result["too_short"]:  # leave short copy uncached so a re-prompt can do better
+            _cache.set(key, result)
+        return result
+    except Exception as e:
+        _breaker_record(breaker, ok=False)
+        return {"success": False, "error": f"Groq chat error: {e}"}
+
+async def agenerate_storyline(product_input: str, groq_api_key: str, model: str = "llama-3.3-70b-versatile", use_cache: bool = True) -> Dict[str, Any]:
+    key = _cache_key(product_input, groq_api_key, model)
+    if use_cache:
+        cached = _cache.get(key)
+        if cached is not None:
+            return cached
+
+    breaker = _breaker_name(groq_api_key, model)
+    if _breaker_open(breaker):
+        return {"success": False, "error": f"Groq chat error: {model} is temporarily skipped after repeated failures"}
 
-        tagline, narrative = "", ""
-        for line in text.splitlines():
-            s = line.strip()
-            if s.startswith("TAGLINE:"):
-                tagline = s[len("TAGLINE:"):].strip()
-            elif s.startswith("NARRATIVE:"):
-                narrative = s[len("NARRATIVE:"):].strip()
-
-        # Fallback parsing
-        if not tagline or not narrative:
-            lines = [ln.strip() for ln in text.splitlines() if ln.strip()]
-            if lines:
-                tagline = tagline or lines[0][:120]
-                narrative = narrative or " ".join(lines[1:])[:1500]
-
-        # Enforce lengths
-        tw = tagline.split()
-        if len(tw) > 15:
-            tagline = " ".join(tw[:15])
-        if len(tw) < 10:
-            tagline = " ".join((tw + [""] * (10 - len(tw))))[:120].strip()
-
-        nw = narrative.split()
-        if len(nw) > 150:
-            narrative = " ".join(nw[:150])
-        elif len(nw) < 100:
-            narrative = " ".join(nw + [""] * (100 - len(nw))).strip()
-
-        return {"success": True, "tagline": tagline, "narrative": narrative, "model": model}
+    client = get_async_client(groq_api_key)
+
+    try:
+        with _cache.timed():
+            resp = await client.chat.completions.create(
+                model=model,
+                messages=_build_messages(product_input),
+                temperature=0.7,
+                max_tokens=_max_tokens(product_input),
+            )
+        text = resp.choices[0].message.content or ""
+        result = parse_storyline(text, model)
+        _breaker_record(breaker, ok=True)
+        if not result["too_short"]:  # leave short copy uncached so a re-prompt can do better
+            _cache.set(key, result)
+        return result
     except Exception as e:
+        _breaker_record(breaker, ok=False)
         return {"success": False, "error": f"Groq chat error: {e}"}
 
+async def agenerate_storyline_batch(product_inputs: List[str], groq_api_key: str, model: str = "llama-3.3-70b-versatile", max_concurrency: int = 8) -> List[Dict[str, Any]]:
+    # Fan out many products at once; the semaphore keeps bursts under provider rate limits
+    sem = asyncio.Semaphore(max_concurrency)
 
+    async def _one(product_input: str) -> Dict[str, Any]:
+        async with sem:
+            return await agenerate_storyline(product_input, groq_api_key, model)
+
+    # Repeated products (same cache key) share one request
+    buckets: Dict[str, List[int]] = {}
+    for i, p in enumerate(product_inputs):
+        buckets.setdefault(_cache_key(p, groq_api_key, model), []).append(i)
+    unique = [product_inputs[idxs[0]] for idxs in buckets.values()]
+    done = await asyncio.gather(*(_one(p) for p in unique))
+
+    # Results come back in input order; failures are {"success": False, ...} entries
+    by_index = {i: result for idxs, result in zip(buckets.values(), done) for i in idxs}
+    return [dict(by_index[i]) for i in range(len(product_inputs))]
+
+def generate_storyline_stream(product_input: str, groq_api_key: str, model: str = "llama-3.3-70b-versatile", use_cache: bool = True) -> Iterator[str]:
+    # Yields text deltas as they arrive (e.g. for st.write_stream); feed the
+    # joined text to parse_storyline. Like SceneGenerator.generate_scenes_stream,
+    # failures are logged and end the stream instead of raising.
+    key = _cache_key(product_input, groq_api_key, model)
+    if use_cache:
+        cached = _cache.get(key)
+        if cached is not None:
+            yield f"TAGLINE: {cached['tagline']}\nNARRATIVE: {cached['narrative']}"
+            return
+
+    breaker = _breaker_name(groq_api_key, model)
+    if _breaker_open(breaker):
+        logger.warning("Storyline streaming skipped (%s): temporarily disabled after repeated failures", model)
+        return
+
+    parts = []
+    try:
+        with _cache.timed():
+            stream = get_client(groq_api_key).chat.completions.create(
+                model=model,
+                messages=_build_messages(product_input),
+                temperature=0.7,
+                max_tokens=_max_tokens(product_input),
+                stream=True,
+            )
+            with closing(iter_deltas(stream)) as deltas:
+                for delta in deltas:
+                    parts.append(delta)
+                    yield delta
+    except Exception as e:
+        _breaker_record(breaker, ok=False)
+        logger.warning("Storyline streaming failed (%s): %s", model, e)
+        return
+    _breaker_record(breaker, ok=True)
+
+    result = parse_storyline("".join(parts), model)
+    if not result["too_short"]:
+        _cache.set(key, result)
+
+async def agenerate_storyline_stream(product_input: str, groq_api_key: str, model: str = "llama-3.3-70b-versatile", use_cache: bool = True) -> AsyncIterator[str]:
+    # Async counterpart of generate_storyline_stream, e.g. for a StreamingResponse
+    key = _cache_key(product_input, groq_api_key, model)
+    if use_cache:
+        cached = _cache.get(key)
+        if cached is not None:
+            yield f"TAGLINE: {cached['tagline']}\nNARRATIVE: {cached['narrative']}"
+            return
+
+    breaker = _breaker_name(groq_api_key, model)
+    if _breaker_open(breaker):
+        logger.warning("Storyline streaming skipped (%s): temporarily disabled after repeated failures", model)
+        return
+
+    parts = []
+    try:
+        with _cache.timed():
+            stream = await get_async_client(groq_api_key).chat.completions.create(
+                model=model,
+                messages=_build_messages(product_input),
+                temperature=0.7,
+                max_tokens=_max_tokens(product_input),
+                stream=True,
+            )
+            deltas = aiter_deltas(stream)
+            try:
+                async for delta in deltas:
+                    parts.append(delta)
+                    yield delta
+            finally:
+                await deltas.aclose()
+    except Exception as e:
+        _breaker_record(breaker, ok=False)
+        logger.warning("Storyline streaming failed (%s): %s", model, e)
+        return
+    _breaker_record(breaker, ok=True)
+
+    result = parse_storyline("".join(parts), model)
+    if not result["too_short"]:
+        _cache.set(key, result)
+
+def submit_storyline_batch(product_inputs: List[str], groq_api_key: str, model: str = "llama-3.3-70b-versatile", completion_window: str = "24h") -> str:
+    # Latency-tolerant bulk path: Groq's Batch API is cheaper and sits outside
+    # the interactive rate limits. Returns the batch id to poll.
+    lines = [
+        json.dumps({
+            "custom_id": f"storyline-{i}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {"model": model, "messages": _build_messages(p), "temperature": 0.7, "max_tokens": _max_tokens(p)},
+        })
+        for i, p in enumerate(product_inputs)
+    ]
+    client = get_client(groq_api_key)
+    upload = client.files.create(file=("storylines.jsonl", "\n".join(lines).encode()), purpose="batch")
+    batch = client.batches.create(
+        completion_window=completion_window,
+        endpoint="/v1/chat/completions",
+        input_file_id=upload.id,
+    )
+    return batch.id
+
+# Batch statuses that will not change any more ("cancelling" still can)
+_BATCH_TERMINAL = ("completed", "failed", "expired", "cancelled")
+
+def _read_batch_lines(client, file_id: str) -> List[Dict[str, Any]]:
+    text = client.files.content(file_id).text()
+    return [json.loads(ln) for ln in text.splitlines() if ln.strip()]
+
+def fetch_storyline_batch(batch_id: str, groq_api_key: str) -> Dict[str, Any]:
+    client = get_client(groq_api_key)
+    try:
+        batch = client.batches.retrieve(batch_id)
+        if batch.status not in _BATCH_TERMINAL:
+            return {"success": False, "status": batch.status, "done": False}
+        # Expired/cancelled batches can still carry completed (billed) results
+        if not (batch.output_file_id or batch.error_file_id):
+            return {"success": False, "status": batch.status, "done": True}
+
+        total = batch.request_counts.total if batch.request_counts else 0
+        items = []
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                items.extend(_read_batch_lines(client, file_id))
+
+        by_index: Dict[int, Dict[str, Any]] = {}
+        for item in items:
+            idx = int(item["custom_id"].rsplit("-", 1)[1])
+            response = item.get("response") or {}
+            if response.get("status_code") == 200:
+                body = response["body"]
+                text = body["choices"][0]["message"]["content"] or ""
+                by_index[idx] = parse_storyline(text, body.get("model", ""))
+            else:
+                by_index[idx] = {"success": False, "error": f"Groq batch error: {item.get('error') or response}"}
+
+        total = max([total, *(i + 1 for i in by_index)])
+        storylines = [
+            by_index.get(i) or {"success": False, "error": "No result in batch output"}
+            for i in range(total)
+        ]
+        return {"success": True, "status": batch.status, "done": True, "storylines": storylines}
+    except Exception as e:
+        return {"success": False, "status": "error", "done": True, "error": f"Groq batch error: {e}"}
 
+def wait_storyline_batch(batch_id: str, groq_api_key: str, max_wait_sec: float = 3600) -> Dict[str, Any]:
+    # Poll with exponential backoff (2s, 4s, ... capped at 60s)
+    deadline = time.monotonic() + max_wait_sec
+    delay = 2.0
+    while True:
+        res = fetch_storyline_batch(batch_id, groq_api_key)
+        if res["done"] or time.monotonic() + delay > deadline:
+            return res
+        time.sleep(delay)
+        delay = min(delay * 2, 60.0)
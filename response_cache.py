@@ -0,0 +1,127 @@
+import copy
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+try:
+    import orjson  # optional: faster canonical serialization for cache keys
+except ImportError:
+    orjson = None
+
+class ResponseCache:
+    def __init__(
+        self,
+        max_entries: int = 256,
+        ttl: float = 3600,
+        directory: Optional[str] = None,
+        size_limit: int = 256 << 20,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._counts: Counter = Counter()
+        self._latencies: deque = deque(maxlen=100)  # seconds spent on uncached calls
+        # Optional on-disk tier shared across restarts and worker processes
+        self._disk = None
+        if directory:
+            import diskcache
+            self._disk = diskcache.Cache(directory, size_limit=size_limit)
+
+    def _get_memory(self, key: str) -> Optional[Any]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def _set_memory(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def get(self, key: str) -> Optional[Any]:
+        value = self._get_memory(key)
+        from_disk = False
+        if value is None and self._disk is not None:
+            value = self._disk.get(key)
+            if value is not None:
+                from_disk = True
+                self._set_memory(key, value)
+        # Counter updates are read-modify-write, so concurrent callers must hold the lock
+        with self._lock:
+            self._counts["disk_hits"] += from_disk
+            self._counts["hits" if value is not None else "misses"] += 1
+        # Hand out copies so callers can't mutate the cached entry
+        return copy.deepcopy(value) if value is not None else None
+
+    def set(self, key: str, value: Any) -> None:
+        value = copy.deepcopy(value)
+        self._set_memory(key, value)
+        if self._disk is not None:
+            self._disk.set(key, value, expire=self.ttl)
+
+    @contextmanager
+    def timed(self) -> Iterator[None]:
+        # Wrap the uncached request so stats can tell misses from slow providers
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._latencies.append(time.perf_counter() - start)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            counts, entries = self._counts.copy(), len(self._data)
+        hits, misses = counts["hits"], counts["misses"]
+        latencies = sorted(self._latencies)
+        return {
+            "hits": hits,
+            "misses": misses,
+            "disk_hits": counts["disk_hits"],
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+            "entries": entries,
+            "p50_sec": latencies[int(0.50 * (len(latencies) - 1))] if latencies else None,
+            "p95_sec": latencies[int(0.95 * (len(latencies) - 1))] if latencies else None,
+        }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+        if self._disk is not None:
+            self._disk.clear()
+
+def cache_dir(name: str) -> Optional[str]:
+    # Set MARKETING_CACHE_DIR to persist responses across restarts; each cache gets
+    # its own subdirectory so clear() and size limits don't reach the others
+    root = os.getenv("MARKETING_CACHE_DIR")
+    return os.path.join(root, name) if root else None
+
+def hash_token(token: str) -> str:
+    # Keep raw API keys out of cache keys
+    return hashlib.blake2b(token.encode(), digest_size=8).hexdigest()
+
+def normalize_prompt(text: str) -> str:
+    # Case, whitespace and a trailing full stop/!/? shouldn't turn a repeat prompt
+    # into a cache miss; other punctuation can change meaning ("50%" vs "$50", "C++")
+    return " ".join(text.lower().split()).rstrip(".!? ")
+
+def make_key(*parts: Any) -> str:
+    # Canonical JSON so dict ordering doesn't cause false misses
+    if orjson is not None:
+        raw = orjson.dumps(parts, option=orjson.OPT_SORT_KEYS, default=str)
+    else:
+        raw = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str).encode()
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
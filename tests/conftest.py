@@ -0,0 +1,106 @@
+import asyncio
+import os
+import sys
+import threading
+from types import SimpleNamespace
+from typing import Callable, List, Optional
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import description
+import marketing_generator
+
+
+def _response(text: str) -> SimpleNamespace:
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=text))])
+
+
+def _chunks(text: str, size: int = 7) -> List[SimpleNamespace]:
+    return [
+        SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text[i:i + size]))])
+        for i in range(0, len(text), size)
+    ]
+
+
+class _Stream:
+    def __init__(self, text: str):
+        self._chunks = _chunks(text)
+        self.closed = False
+
+    def __iter__(self):
+        return iter(self._chunks)
+
+    def close(self) -> None:
+        self.closed = True
+
+
+class _AsyncStream:
+    def __init__(self, text: str):
+        self._it = iter(_chunks(text))
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._it)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    async def close(self) -> None:
+        self.closed = True
+
+
+class StubGroq:
+    """Stands in for both Groq and AsyncGroq; records every chat request."""
+
+    def __init__(self, reply: str = ""):
+        self.reply = reply
+        self.error: Optional[Exception] = None
+        self.delay = 0.0
+        self.calls: List[dict] = []
+        self.streams: List = []
+        self.release = threading.Event()
+        self.release.set()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+        self.achat = SimpleNamespace(completions=SimpleNamespace(create=self._acreate))
+
+    def _record(self, kw: dict) -> None:
+        self.calls.append(kw)
+        if self.error is not None:
+            raise self.error
+
+    def _create(self, **kw):
+        self._record(kw)
+        self.release.wait(5)
+        if kw.get("stream"):
+            self.streams.append(_Stream(self.reply))
+            return self.streams[-1]
+        return _response(self.reply)
+
+    async def _acreate(self, **kw):
+        self._record(kw)
+        await asyncio.sleep(self.delay)
+        if kw.get("stream"):
+            self.streams.append(_AsyncStream(self.reply))
+            return self.streams[-1]
+        return _response(self.reply)
+
+
+@pytest.fixture
+def stub(monkeypatch) -> StubGroq:
+    client = StubGroq()
+    async_client = SimpleNamespace(chat=client.achat)
+    sync: Callable[[str], StubGroq] = lambda key: client
+    for module in (description, marketing_generator):
+        monkeypatch.setattr(module, "get_client", sync)
+        monkeypatch.setattr(module, "get_async_client", lambda key: async_client)
+    description._cache.clear()
+    marketing_generator._cache.clear()
+    marketing_generator._breaker.clear()
+    description._inflight.clear()
+    description._ainflight.clear()
+    return client
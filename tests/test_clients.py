@@ -0,0 +1,81 @@
+import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import clients
+import marketing_generator as mg
+
+REPLY = "TAGLINE: " + " ".join(["word"] * 12) + "\nNARRATIVE: " + " ".join(["n"] * 120)
+
+
+class _ChatHandler(BaseHTTPRequestHandler):
+    # Minimal OpenAI-compatible chat endpoint with HTTP/1.1 keep-alive
+    protocol_version = "HTTP/1.1"
+    hits = 0
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        type(self).hits += 1
+        if body.get("stream"):
+            chunk = {
+                "id": "c", "object": "chat.completion.chunk", "created": 0, "model": body["model"],
+                "choices": [{"index": 0, "delta": {"content": REPLY}, "finish_reason": None}],
+            }
+            payload = f"data: {json.dumps(chunk)}\n\ndata: [DONE]\n\n".encode()
+            ctype = "text/event-stream"
+        else:
+            payload = json.dumps({
+                "id": "c", "object": "chat.completion", "created": 0, "model": body["model"],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": REPLY}, "finish_reason": "stop"}],
+            }).encode()
+            ctype = "application/json"
+        self.send_response(200)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def chat_server(monkeypatch):
+    _ChatHandler.hits = 0
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _ChatHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setenv("GROQ_BASE_URL", f"http://127.0.0.1:{server.server_port}")
+    clients.close_all_clients()
+    mg._cache.clear()
+    mg._breaker.clear()
+    yield _ChatHandler
+    clients.close_all_clients()
+    server.shutdown()
+    server.server_close()
+
+
+def test_async_client_survives_separate_event_loops(chat_server):
+    for expected in (1, 2, 3):
+        res = asyncio.run(mg.agenerate_storyline(f"product {expected}", "k", use_cache=False))
+        assert res["success"]
+        assert chat_server.hits == expected
+
+
+def test_eviction_leaves_in_use_clients_open(chat_server):
+    first = clients.get_client("k0")
+    for i in range(1, clients._MAX_CLIENTS + 2):
+        clients.get_client(f"k{i}")
+    assert "k0" not in clients._clients
+    resp = first.chat.completions.create(model="m", messages=[{"role": "user", "content": "hi"}])
+    assert resp.choices[0].message.content == REPLY
+
+    async def run():
+        held = clients.get_async_client("a0")
+        for i in range(1, clients._MAX_CLIENTS + 2):
+            clients.get_async_client(f"a{i}")
+        return await held.chat.completions.create(model="m", messages=[{"role": "user", "content": "hi"}])
+
+    assert asyncio.run(run()).choices[0].message.content == REPLY
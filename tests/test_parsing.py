@@ -0,0 +1,80 @@
+import json
+
+import pytest
+
+from description import SceneGenerator, _iter_scenes
+from marketing_generator import parse_storyline
+from word_budgets import NARRATIVE_WORDS, TAGLINE_WORDS
+
+SCENES_DOC = json.dumps(
+    {
+        "tagline": 'say "scenes" [',
+        "scenes": [{"id": i, "title": "a}b{[", "meta": {"x": [1, 2]}} for i in range(4)],
+    },
+    indent=1,
+)
+
+
+@pytest.mark.parametrize("step", [1, 3, 50, len(SCENES_DOC)])
+def test_iter_scenes_yields_every_scene_for_any_chunking(step):
+    chunks = (SCENES_DOC[i:i + step] for i in range(0, len(SCENES_DOC), step))
+    assert [s["id"] for s in _iter_scenes(chunks)] == [0, 1, 2, 3]
+
+
+def test_iter_scenes_ignores_text_after_the_array():
+    text = '{"scenes": [{"id": 1}]} trailing {"id": 2}'
+    assert [s["id"] for s in _iter_scenes([text])] == [1]
+
+
+def _words(n: int, word: str = "w") -> str:
+    return " ".join([word] * n)
+
+
+def test_parse_storyline_reads_labelled_multiline_narrative():
+    text = f"TAGLINE: {_words(12)}\nNARRATIVE: {_words(60, 'a')}\n\n{_words(60, 'b')}"
+    res = parse_storyline(text, "m")
+    assert res["success"] and not res["too_short"]
+    assert len(res["tagline"].split()) == 12
+    assert res["narrative"].split().count("b") == 60
+
+
+@pytest.mark.parametrize(
+    "trailer",
+    ["\n\nLet me know if you'd like another version!", "\n```", "\n```\n\nI hope this helps.", "\n---\nNote: tweak freely"],
+)
+def test_parse_storyline_drops_trailing_chatter(trailer):
+    narrative = _words(110, "n")
+    res = parse_storyline(f"Sure!\n```\nTAGLINE: {_words(12)}\nNARRATIVE: {narrative}{trailer}", "m")
+    assert res["narrative"] == narrative
+
+
+def test_parse_storyline_truncates_to_upper_bounds():
+    text = f"TAGLINE: {_words(40)}\nNARRATIVE: {_words(400)}"
+    res = parse_storyline(text, "m")
+    assert len(res["tagline"].split()) == TAGLINE_WORDS[1]
+    assert len(res["narrative"].split()) == NARRATIVE_WORDS[1]
+
+
+@pytest.mark.parametrize(
+    "reply",
+    [
+        '{"scenes": [{"id": 1}]}',
+        'Sure! ```json\n{"scenes": [{"id": 1}]}\n``` hope it helps {}',
+        'Here you go: {"scenes": [{"id": 1}]} Let me know!',
+    ],
+)
+def test_extract_json_handles_fences_and_chatter(reply):
+    assert SceneGenerator._extract_json(reply) == {"scenes": [{"id": 1}]}
+
+
+def test_extract_json_raises_without_an_object():
+    with pytest.raises(ValueError):
+        SceneGenerator._extract_json("no json here")
+
+
+def test_parse_storyline_flags_short_and_unlabelled_replies():
+    res = parse_storyline("Great shoes\nThey are comfy.", "m")
+    assert res["tagline"] == "Great shoes"
+    assert res["narrative"] == "They are comfy."
+    assert res["too_short"]
+    assert parse_storyline("", "m")["too_short"]
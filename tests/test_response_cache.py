@@ -0,0 +1,48 @@
+import threading
+
+import pytest
+
+from response_cache import ResponseCache, cache_dir, normalize_prompt
+
+
+def test_stats_count_every_lookup_under_concurrency():
+    cache = ResponseCache()
+    cache.set("hit", 1)
+
+    def lookups():
+        for _ in range(2000):
+            cache.get("hit")
+            cache.get("miss")
+
+    threads = [threading.Thread(target=lookups) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    stats = cache.stats()
+    assert stats["hits"] == stats["misses"] == 16000
+    assert stats["hit_rate"] == 0.5
+
+
+def test_each_cache_gets_its_own_directory(tmp_path, monkeypatch):
+    pytest.importorskip("diskcache")
+    monkeypatch.setenv("MARKETING_CACHE_DIR", str(tmp_path))
+    scenes, storyline = ResponseCache(directory=cache_dir("scenes")), ResponseCache(directory=cache_dir("storyline"))
+    scenes.set("k", "scene")
+    storyline.set("k", "story")
+    scenes.clear()
+    assert ResponseCache(directory=cache_dir("storyline")).get("k") == "story"
+    monkeypatch.delenv("MARKETING_CACHE_DIR")
+    assert cache_dir("scenes") is None
+
+
+@pytest.mark.parametrize(
+    "a, b",
+    [("Save 50%", "Save $50"), ("C++ IDE", "C IDE"), ("+5 dB", "-5 dB"), ("Grade A+", "Grade A-")],
+)
+def test_normalize_prompt_keeps_meaningful_punctuation(a, b):
+    assert normalize_prompt(a) != normalize_prompt(b)
+
+
+def test_normalize_prompt_folds_case_whitespace_and_final_punctuation():
+    assert normalize_prompt("  Eco  Bottle!\n") == normalize_prompt("eco bottle.") == "eco bottle"
@@ -0,0 +1,155 @@
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+
+from description import SceneGenerator
+
+SCENES_REPLY = json.dumps({"scenes": [{"id": 1, "title": "a"}, {"id": 2, "title": "b"}]})
+STORYLINE = {"tagline": "t", "narrative": "n"}
+
+
+def test_stream_yields_scenes_and_fills_the_cache(stub):
+    stub.reply = "```json\n" + SCENES_REPLY + "\n```"
+    gen = SceneGenerator("k")
+    assert [s["id"] for s in gen.generate_scenes_stream(STORYLINE, 2, "15s")] == [1, 2]
+    assert [s["id"] for s in gen.generate_scenes_stream(STORYLINE, 2, "15s")] == [1, 2]
+    assert len(stub.calls) == 1
+
+
+def test_stream_closes_the_response_when_the_consumer_stops(stub):
+    stub.reply = SCENES_REPLY
+    gen = SceneGenerator("k").generate_scenes_stream(STORYLINE, 2, "15s")
+    next(gen)
+    gen.close()
+    assert stub.streams[-1].closed
+
+
+def test_stream_failure_yields_nothing(stub):
+    stub.error = RuntimeError("down")
+    assert list(SceneGenerator("k").generate_scenes_stream(STORYLINE, 2, "15s")) == []
+
+
+def test_sync_callers_share_one_request(stub):
+    stub.reply = SCENES_REPLY
+    stub.release.clear()
+    gen = SceneGenerator("k", use_cache=False)
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(gen.generate_scenes(STORYLINE, 2, "15s")))
+        for _ in range(4)
+    ]
+    for t in threads:
+        t.start()
+    while not stub.calls:
+        time.sleep(0.01)
+    time.sleep(0.1)  # let the other threads join the in-flight request
+    stub.release.set()
+    for t in threads:
+        t.join(5)
+    assert len(stub.calls) == 1
+    assert [len(r) for r in results] == [2, 2, 2, 2]
+
+
+def test_async_callers_share_one_request(stub):
+    stub.reply = SCENES_REPLY
+    stub.delay = 0.05
+    gen = SceneGenerator("k", use_cache=False)
+
+    async def run():
+        return await asyncio.gather(*(gen.agenerate_scenes(STORYLINE, 2, "15s") for _ in range(5)))
+
+    results = asyncio.run(run())
+    assert len(stub.calls) == 1
+    assert [len(r) for r in results] == [2] * 5
+    results[0][0]["title"] = "changed"
+    assert results[1][0]["title"] == "a"
+
+
+def test_cancelled_follower_does_not_break_the_leader(stub):
+    stub.reply = SCENES_REPLY
+    stub.delay = 0.1
+    gen = SceneGenerator("k", use_cache=False)
+
+    async def run():
+        leader = asyncio.create_task(gen.agenerate_scenes(STORYLINE, 2, "15s"))
+        await asyncio.sleep(0)
+        other = asyncio.create_task(gen.agenerate_scenes(STORYLINE, 2, "15s"))
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(gen.agenerate_scenes(STORYLINE, 2, "15s"), 0.01)
+        return await leader, await other
+
+    leader_scenes, other_scenes = asyncio.run(run())
+    assert len(leader_scenes) == len(other_scenes) == 2
+    assert len(stub.calls) == 1
+
+
+def test_cancelled_leader_makes_followers_retry(stub):
+    stub.reply = SCENES_REPLY
+    stub.delay = 0.1
+    gen = SceneGenerator("k", use_cache=False)
+
+    async def run():
+        leader = asyncio.create_task(gen.agenerate_scenes(STORYLINE, 2, "15s"))
+        await asyncio.sleep(0)
+        followers = [asyncio.create_task(gen.agenerate_scenes(STORYLINE, 2, "15s")) for _ in range(3)]
+        await asyncio.sleep(0.02)
+        leader.cancel()
+        return await asyncio.gather(*followers)
+
+    results = asyncio.run(run())
+    assert [len(r) for r in results] == [2, 2, 2]
+    assert len(stub.calls) == 2  # the cancelled attempt and one retry
+
+
+def test_sync_call_does_not_wait_on_an_async_leader(stub):
+    stub.reply = SCENES_REPLY
+    stub.delay = 0.2
+    gen = SceneGenerator("k", use_cache=False)
+    out = []
+
+    async def run():
+        leader = asyncio.create_task(gen.agenerate_scenes(STORYLINE, 2, "15s"))
+        await asyncio.sleep(0.01)
+        out.append(gen.generate_scenes(STORYLINE, 2, "15s"))  # on the loop thread
+        out.append(await leader)
+
+    worker = threading.Thread(target=asyncio.run, args=(run(),), daemon=True)
+    worker.start()
+    worker.join(5)
+    assert not worker.is_alive(), "sync caller deadlocked on the async leader"
+    assert [len(r) for r in out] == [2, 2]
+
+
+def test_failed_request_returns_no_scenes_and_releases_followers(stub):
+    stub.error = RuntimeError("down")
+    gen = SceneGenerator("k", use_cache=False)
+    assert gen.generate_scenes(STORYLINE, 2, "15s") == []
+    stub.error = None
+    stub.reply = SCENES_REPLY
+    assert len(gen.generate_scenes(STORYLINE, 2, "15s")) == 2
+
+
+def test_bulk_splits_storyboards_by_id(stub):
+    stub.reply = json.dumps(
+        {"storyboards": [{"storyline_id": "b", "scenes": [{"id": 2}]}, {"storyline_id": "0", "scenes": [{"id": 1}]}]}
+    )
+    gen = SceneGenerator("k", use_cache=False)
+    res = gen.generate_scenes_bulk([{"tagline": "a"}, {"id": "b", "tagline": "b"}], 1, "15s")
+    assert res == {"0": [{"id": 1}], "b": [{"id": 2}]}
+
+
+def test_bulk_tolerates_malformed_replies(stub):
+    gen = SceneGenerator("k", use_cache=False)
+    storylines = [{"tagline": "a"}, {"tagline": "b"}]
+    for reply in ("[1, 2]", '{"storyboards": [1, "x"]}', '{"storyboards": {"0": []}}'):
+        stub.reply = reply
+        assert gen.generate_scenes_bulk(storylines, 1, "15s") == {"0": [], "1": []}
+
+
+def test_bulk_rejects_duplicate_ids(stub):
+    gen = SceneGenerator("k", use_cache=False)
+    with pytest.raises(ValueError):
+        gen.generate_scenes_bulk([{"id": "x"}, {"id": "x"}], 1, "15s")
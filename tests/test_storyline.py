@@ -0,0 +1,136 @@
+import asyncio
+
+import marketing_generator as mg
+
+GOOD = "TAGLINE: " + " ".join(["word"] * 12) + "\nNARRATIVE: " + " ".join(["n"] * 120)
+SHORT = "TAGLINE: tiny\nNARRATIVE: short"
+
+
+def test_output_is_capped_with_max_tokens_not_an_early_close(stub):
+    stub.reply = "TAGLINE: " + " ".join(["w"] * 12) + "\nNARRATIVE: " + " ".join(["n"] * 400)
+    res = mg.generate_storyline("long", "k")
+    assert len(res["narrative"].split()) == mg.NARRATIVE_WORDS[1]
+    asyncio.run(mg.agenerate_storyline("long async", "k"))
+    for call in stub.calls:
+        assert not call.get("stream")
+        assert mg._MAX_TOKENS[0] <= call["max_tokens"] <= mg._MAX_TOKENS[1]
+
+
+def test_stream_closes_the_response_when_the_consumer_stops(stub):
+    stub.reply = GOOD
+    gen = mg.generate_storyline_stream("shoes", "k")
+    next(gen)
+    gen.close()
+    assert stub.streams[-1].closed
+
+
+def test_stream_is_timed_and_cached(stub):
+    stub.reply = GOOD
+    text = "".join(mg.generate_storyline_stream("shoes", "k"))
+    assert mg.parse_storyline(text, "m")["success"]
+    assert stub.streams[-1].closed
+    assert mg.cache_stats()["p50_sec"] is not None
+    assert "".join(mg.generate_storyline_stream("shoes", "k")).startswith("TAGLINE:")
+    assert len(stub.calls) == 1
+
+
+def test_stream_failure_is_logged_and_counts_towards_the_breaker(stub, monkeypatch, caplog):
+    monkeypatch.setattr(mg, "_BREAKER_FAILURES", 2)
+    stub.error = RuntimeError("down")
+    for i in range(3):
+        assert list(mg.generate_storyline_stream(f"p{i}", "k")) == []
+    assert len(stub.calls) == 2
+    assert "Storyline streaming failed" in caplog.text
+    assert "temporarily disabled" in caplog.text
+
+
+def test_async_stream_closes_the_response_when_the_consumer_stops(stub):
+    stub.reply = GOOD
+
+    async def run():
+        gen = mg.agenerate_storyline_stream("shoes", "k")
+        await gen.__anext__()
+        await gen.aclose()
+
+    asyncio.run(run())
+    assert stub.streams[-1].closed
+
+
+def test_async_stream_is_timed_cached_and_guarded_like_the_sync_one(stub, monkeypatch, caplog):
+    async def collect(product):
+        return "".join([d async for d in mg.agenerate_storyline_stream(product, "k")])
+
+    stub.reply = GOOD
+    assert asyncio.run(collect("shoes")).startswith("TAGLINE:")
+    assert stub.streams[-1].closed
+    assert mg.cache_stats()["p50_sec"] is not None
+    asyncio.run(collect("shoes"))
+    assert len(stub.calls) == 1
+
+    monkeypatch.setattr(mg, "_BREAKER_FAILURES", 2)
+    stub.error = RuntimeError("down")
+    for i in range(3):
+        assert asyncio.run(collect(f"p{i}")) == ""
+    assert len(stub.calls) == 3
+    assert "Storyline streaming failed" in caplog.text
+    assert "temporarily disabled" in caplog.text
+
+
+def test_storyline_is_cached(stub):
+    stub.reply = GOOD
+    assert mg.generate_storyline("shoes", "k")["success"]
+    assert mg.generate_storyline("  Shoes ", "k")["success"]
+    assert len(stub.calls) == 1
+
+
+def test_short_storyline_is_not_cached(stub):
+    stub.reply = SHORT
+    assert mg.generate_storyline("shoes", "k")["too_short"]
+    stub.reply = GOOD
+    assert not mg.generate_storyline("shoes", "k")["too_short"]
+    assert len(stub.calls) == 2
+
+
+def test_batch_deduplicates_repeated_products(stub):
+    stub.reply = GOOD
+    out = asyncio.run(mg.agenerate_storyline_batch(["a", "b", "A", "a"], "k"))
+    assert len(stub.calls) == 2
+    assert [o["success"] for o in out] == [True] * 4
+    assert out[0] == out[2] and out[0] is not out[3]
+
+
+def test_breaker_opens_after_consecutive_failures(stub, monkeypatch):
+    monkeypatch.setattr(mg, "_BREAKER_FAILURES", 3)
+    stub.error = RuntimeError("down")
+    for i in range(5):
+        res = mg.generate_storyline(f"p{i}", "k")
+        assert not res["success"]
+    assert len(stub.calls) == 3
+    assert "temporarily skipped" in res["error"]
+
+    # Other keys are unaffected
+    stub.error = None
+    stub.reply = GOOD
+    assert mg.generate_storyline("p", "other")["success"]
+
+
+def test_breaker_resets_on_success(stub, monkeypatch):
+    monkeypatch.setattr(mg, "_BREAKER_FAILURES", 2)
+    stub.error = RuntimeError("down")
+    mg.generate_storyline("a", "k")
+    stub.error = None
+    stub.reply = GOOD
+    assert mg.generate_storyline("b", "k")["success"]
+    stub.error = RuntimeError("down")
+    mg.generate_storyline("c", "k")
+    stub.error = None
+    assert mg.generate_storyline("d", "k")["success"]
+
+
+def test_breaker_reopens_after_cooldown_on_next_failure(stub, monkeypatch):
+    monkeypatch.setattr(mg, "_BREAKER_FAILURES", 1)
+    monkeypatch.setattr(mg, "_BREAKER_COOLDOWN", 0.0)
+    stub.error = RuntimeError("down")
+    mg.generate_storyline("a", "k")
+    mg.generate_storyline("b", "k")
+    assert len(stub.calls) == 2
@@ -0,0 +1,30 @@
+import logging
+from typing import Tuple
+
+logger = logging.getLogger(__name__)
+
+# Word budgets promised in the storyline prompts and enforced by enforce_word_budgets
+TAGLINE_WORDS = (10, 15)
+NARRATIVE_WORDS = (100, 150)
+
+def enforce_word_budgets(tagline: str, narrative: str) -> Tuple[str, str, bool]:
+    # Enforce upper bounds; short sections can't be padded into real copy,
+    # so keep them as-is and flag them so callers can re-prompt
+    too_short = False
+    tag_min, tag_max = TAGLINE_WORDS
+    tw = tagline.split()
+    if len(tw) > tag_max:
+        tagline = " ".join(tw[:tag_max])
+    elif len(tw) < tag_min:
+        too_short = True
+        logger.warning("Tagline has %d words, expected at least %d", len(tw), tag_min)
+
+    nar_min, nar_max = NARRATIVE_WORDS
+    nw = narrative.split()
+    if len(nw) > nar_max:
+        narrative = " ".join(nw[:nar_max])
+    elif len(nw) < nar_min:
+        too_short = True
+        logger.warning("Narrative has %d words, expected at least %d", len(nw), nar_min)
+
+    return tagline, narrative, too_short